@@ -1,51 +1,124 @@
 print("main.py")
 
-from machine import Pin, TouchPad
-import time
+import asyncio
+from machine import EXT0_WAKE, Counter, Pin, TouchPad, deepsleep, lightsleep, wake_reason
+import micropython
+from micropython import const
+# Imported by name, as attribute lookups on the `time` module are not free in the hot loops.
+from time import ticks_add, ticks_diff, ticks_ms
 
-from esp32 import NVS
+from esp32 import NVS, wake_on_ext0
+
+# Whether to print a trace of the timing and of each step while the blind is moving.
+# Being a const, the compiler drops the trace code entirely if disabled.
+_TRACE = const(0)
 
 # An ADC value read from a touch sensor indicates that the button was pressed.
-TOUCH_ADC_THRESHOLD = 300
+TOUCH_ADC_THRESHOLD = const(300)
 
 # Duration of how long a button needs to be pressed for
-# causing a press event to be fired.
-BUTTON_PRESS_EVENT_THRESHOLD_MS = 200
+# causing a press event to be fired. Since the touch pad readings are
+# low-pass filtered (see TOUCH_FILTER_SHIFT), this only needs to cover
+# accidental touches, not noise.
+BUTTON_PRESS_EVENT_THRESHOLD_MS = const(50)
+
+# Strength of the IIR low-pass filter applied to the touch pad readings.
+# Each new reading contributes 1 / 2**TOUCH_FILTER_SHIFT to the filtered value.
+TOUCH_FILTER_SHIFT = const(2)
+
+# Interval in which the buttons are polled. Sampling the touch pads faster than
+# this does not improve responsiveness, but keeps the CPU busy.
+BUTTON_POLL_INTERVAL_MS = const(10)
 
 # The logic level that indicated that the hall sensor is above a magnet.
-ABOVE_MAGNET_LOGIC_LEVEL = 0
+ABOVE_MAGNET_LOGIC_LEVEL = const(0)
 
 # The logic level that indicates that the hall sensor is between two magnets.
-NOT_ABOVE_MAGNET_LOGIC_LEVEL = int(ABOVE_MAGNET_LOGIC_LEVEL == 0)
+NOT_ABOVE_MAGNET_LOGIC_LEVEL = const(1 - ABOVE_MAGNET_LOGIC_LEVEL)
+
+# How long to sleep after a failed movement until the device is reset and retries.
+FAULT_RETRY_DELAY_MS = const(60_000)
+
+# Waits shorter than this are not worth entering light sleep for.
+LIGHTSLEEP_MIN_MS = const(2)
 
 # Total number of magnets evenly distributed on a circle.
-NUM_MAGNETS = 4
+NUM_MAGNETS = const(4)
+
+# Minimal pulse width of the hall sensor signal, shorter glitches are not counted.
+HALL_SENSOR_FILTER_NS = const(1000)
 
 
 class Settings:
     NUMBER_OF_TOTAL_STEPS_KEY = "R"
+    CURRENT_POSITION_KEY = "P"
 
     def __init__(self) -> None:
         self._nvs = NVS("settings")
+        self._number_of_total_steps_cached = self._get_i32(
+            Settings.NUMBER_OF_TOTAL_STEPS_KEY
+        )
+        self._current_position_cached = self._get_i32(Settings.CURRENT_POSITION_KEY)
+        # Whether there are changes that have not been committed to the flash yet.
+        self._dirty = False
+
+    def _get_i32(self, key: str) -> int | None:
         try:
-            self._number_of_total_steps_cached = self._nvs.get_i32(
-                Settings.NUMBER_OF_TOTAL_STEPS_KEY
-            )
+            return self._nvs.get_i32(key)
         except OSError:
-            self._number_of_total_steps_cached = None
+            return None
 
     def reset(self):
         self._nvs.erase_key(Settings.NUMBER_OF_TOTAL_STEPS_KEY)
         self._number_of_total_steps_cached = None
+        self.invalidate_current_position()
         self._nvs.commit()
+        self._dirty = False
 
     def number_of_total_steps(self) -> int | None:
         return self._number_of_total_steps_cached
 
     def set_number_of_total_steps(self, val: int):
+        """
+        Update the value. It is only persisted by the next call to `flush()`.
+        """
         self._nvs.set_i32(Settings.NUMBER_OF_TOTAL_STEPS_KEY, val)
         self._number_of_total_steps_cached = val
-        self._nvs.commit()
+        self._dirty = True
+
+    def current_position(self) -> int | None:
+        """
+        The position persisted after the last completed movement, or None if it is unknown.
+        """
+        return self._current_position_cached
+
+    def set_current_position(self, val: int):
+        """
+        Update the value. It is only persisted by the next call to `flush()`.
+        """
+        self._nvs.set_i32(Settings.CURRENT_POSITION_KEY, val)
+        self._current_position_cached = val
+        self._dirty = True
+
+    def invalidate_current_position(self):
+        """
+        Forget the position, e.g., because the blind starts moving.
+        It is only persisted by the next call to `flush()`.
+        """
+        if self._current_position_cached is not None:
+            self._nvs.erase_key(Settings.CURRENT_POSITION_KEY)
+            self._current_position_cached = None
+            self._dirty = True
+
+    def flush(self):
+        """
+        Commit all pending changes to the flash.
+        Committing erases and programs a flash sector, which takes tens of ms, thus this
+        should not be called while we need to be responsive.
+        """
+        if self._dirty:
+            self._nvs.commit()
+            self._dirty = False
 
 
 class Blind:
@@ -85,6 +158,16 @@ class Blind:
         self._pin_b.off()
 
 
+def no_other_tasks() -> bool:
+    """
+    Whether no other asyncio task is scheduled or waiting for IO, i.e., whether blocking
+    the event loop (e.g., by light sleep) delays nobody. asyncio has no public API for
+    this, thus we peek at its queues. Must be called from the running task.
+    """
+    core = asyncio.core
+    return core._task_queue.peek() is None and not core._io_queue.map
+
+
 class RotationSensor:
     """
     The sensor that measures the rotation of the engine that is winding the belt.
@@ -92,23 +175,34 @@ class RotationSensor:
     to the moving part that is winding the belt.
     """
 
-    def __init__(self, hall_pin: Pin) -> None:
-        self._last_irq_ts = time.ticks_ms()
-        self._relativ_position = 0
+    def __init__(self, hall_pin: Pin, counter_id: int = 0) -> None:
         self._hall_pin = hall_pin
-        self._current_level = self._hall_pin.value()
+        # The edges onto a magnet are counted in hardware by the pulse counter (PCNT)
+        # peripheral. Thus, no edge is missed at high speeds and the CPU is not involved.
+        self._counter = Counter(
+            counter_id,
+            hall_pin,
+            edge=Counter.FALLING if ABOVE_MAGNET_LOGIC_LEVEL == 0 else Counter.RISING,
+            filter_ns=HALL_SENSOR_FILTER_NS,
+        )
+        # Magnets we arrived at while in light sleep. The PCNT is not clocked then, thus
+        # these are not part of its count.
+        self._missed = 0
+        # Set by the IRQ handler whenever we arrive at a magnet, so a task waiting while
+        # others are running can be woken up instead of polling the counter.
+        self.sync_event = asyncio.ThreadSafeFlag()
         self._hall_pin.irq(
-            lambda e: self._pin_irq(e.value()), trigger=Pin.IRQ_FALLING | Pin.IRQ_RISING
+            self._pin_irq,
+            trigger=Pin.IRQ_FALLING if ABOVE_MAGNET_LOGIC_LEVEL == 0 else Pin.IRQ_RISING,
+            hard=True,
         )
 
-    def _pin_irq(self, new_value):
-        irq_ts = time.ticks_ms()
-        since_last_irq = time.ticks_diff(irq_ts, self._last_irq_ts)
-        self._last_irq_ts = irq_ts
-
-        self._last_irq_ts = irq_ts
-        print(f"{new_value=}, {irq_ts=}")
-        self._current_level = new_value
+    def _pin_irq(self, pin):
+        # Counting is done by the PCNT, we only need to wake up a task awaiting the flag.
+        # While in light sleep, we are woken up via ext0 instead. Besides the flag, no
+        # state is shared with the IRQ: the count is read from the peripheral and
+        # `_missed` is only touched by the waiting task.
+        self.sync_event.set()
 
     def is_in_sync_position(self) -> bool:
         """
@@ -117,43 +211,94 @@ class RotationSensor:
         return self._hall_pin.value() == ABOVE_MAGNET_LOGIC_LEVEL
 
     def reset_relativ_position(self):
-        self._relativ_position = 0
+        self._counter.value(0)
+        self._missed = 0
 
     def get_relative_position(self) -> int:
-        return self._relativ_position
+        """
+        The number of magnets we arrived at since the last reset.
+        """
+        return self._counter.value() + self._missed
 
-    def wait_for_sync_position(self, timeout_ms: int) -> bool:
+    @micropython.native
+    async def wait_for_sync_position(self, timeout_ms: int) -> bool:
         """
         Wait for the next magnet in order to have a perfectly synchronized position.
-        A magnet can be detected by a rising edge. If we get a rising edge, our sensor is
+        A magnet can be detected by the edge onto it. If we get such an edge, our sensor is
         above a magnet.
-        - However, we do not know on which edge of the magnet:
+        - However, we do not know on which side of the magnet:
         Independent of the rotation direction we know that we moved 1/N * 360deg
-        when we observer a falling edge and than a rising edge (next sync point).
+        when we observe an edge off a magnet and then an edge onto the next one (next sync
+        point).
         - We do not know if we are already on a sync point:
         I guess we should be allowed to assume that the system is not changing the state
         without us being the reason for the change. Probably we need to consider drift causing
         small belt movements etc.
         """
-        start_ts = time.ticks_ms()
-        start_level = self._current_level
-
-        # If we started on a magnet, we first need to wait until we are not above a magnet anymore.
-        if start_level == ABOVE_MAGNET_LOGIC_LEVEL:
-            while True:
-                ts = time.ticks_diff(time.ticks_ms(), start_ts)
-                if ts > timeout_ms:
-                    return False
-                if self._current_level == NOT_ABOVE_MAGNET_LOGIC_LEVEL:
-                    break
-
-        # Now we are not on a magnet anymore, so we wait until we see a magnet again.
+        tms = ticks_ms
+        tdf = ticks_diff
+        deadline = ticks_add(tms(), timeout_ms)
+        count = self._counter.value
+        start_count = count()
+
+        # Whether we have been off a magnet at some point since we started waiting.
+        left_magnet = not self.is_in_sync_position()
+
+        # If we started on a magnet, the next edge onto a magnet can only be observed after
+        # we left it, thus there is no need to wait for the edge off it first.
         while True:
-            ts = time.ticks_diff(time.ticks_ms(), start_ts)
-            if ts > timeout_ms:
+            # Clear the flag before checking the counter, so an edge that arrives in
+            # between is not lost.
+            self.sync_event.clear()
+            if count() != start_count:
+                return True
+            remaining = tdf(deadline, tms())
+            if remaining <= 0:
                 return False
-            if self._current_level == ABOVE_MAGNET_LOGIC_LEVEL:
+
+            # Light sleep blocks the whole event loop, thus we only do so if it delays
+            # nobody. Otherwise, the IRQ handler wakes us up via the flag.
+            if remaining <= LIGHTSLEEP_MIN_MS or not no_other_tasks():
+                try:
+                    await asyncio.wait_for_ms(self.sync_event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return count() != start_count
+                continue
+
+            # Sleep until the hall sensor changes to the level we are waiting for next, or
+            # the timeout expired. The pin level (not the edge) is what wakes us up.
+            wake_on_ext0(
+                self._hall_pin,
+                ABOVE_MAGNET_LOGIC_LEVEL if left_magnet else NOT_ABOVE_MAGNET_LOGIC_LEVEL,
+            )
+            lightsleep(remaining)
+            # The PCNT is not clocked while sleeping and the pin might already have changed
+            # again by now, thus only the wake cause tells us that the awaited edge happened.
+            woken_by_hall_sensor = wake_reason() == EXT0_WAKE
+            # Do not wake up from the deep sleep after a fault because of the hall sensor.
+            wake_on_ext0(None, 0)
+            # Waking up via ext0 leaves the pad routed to the RTC domain, hand it back to
+            # the digital domain so the PCNT and the IRQ see the pin again.
+            self._hall_pin.init(Pin.IN)
+
+            if count() != start_count:
                 return True
+            if woken_by_hall_sensor:
+                if left_magnet:
+                    # We arrived while sleeping, so the PCNT missed the edge.
+                    self._missed += 1
+                    return True
+                # We left the magnet we started on while sleeping. If we already arrived at
+                # the next one since, the ext0 level is met and we wake up right away.
+                left_magnet = True
+
+
+# The button events as consts, so the compiler can inline them in the loops below
+# instead of loading the attributes of `ButtonEvent`.
+_EVT_NONE = const(0)
+_EVT_UP = const(1)
+_EVT_DOWN = const(2)
+_EVT_BOTH = const(3)
 
 
 class ButtonEvent:
@@ -161,10 +306,18 @@ class ButtonEvent:
     The different events that can be fired by pressing buttons and combinations of these.
     """
 
-    NONE = 0
-    UP = 1
-    DOWN = 2
-    BOTH = 3
+    NONE = _EVT_NONE
+    UP = _EVT_UP
+    DOWN = _EVT_DOWN
+    BOTH = _EVT_BOTH
+
+
+# Maps the pressed buttons, packed as (up << 1) | down, to the event they fire.
+_EVENT_LUT = (_EVT_NONE, _EVT_DOWN, _EVT_UP, _EVT_BOTH)
+
+# Start ts of a button that is currently not pressed. Ticks are never negative, and an
+# int sentinel keeps the comparisons cheap for the native emitter (compared to None).
+_NOT_PRESSED = const(-1)
 
 
 class Buttons:
@@ -175,51 +328,60 @@ class Buttons:
     def __init__(self, up_touch: TouchPad, down_touch: TouchPad) -> None:
         self._up = up_touch
         self._down = down_touch
-        self._start_up_ts = None
-        self._start_down_ts = None
+        self.reset()
 
+    def reset(self):
+        """
+        Start over from the current touch pad readings and forget all registered presses.
+        Must be called after `poll_button_event` was not called for a while (e.g., while
+        the blind was moving), since the filter state and the press timestamps are stale
+        then.
+        """
+        self._up_filtered = self._up.read()
+        self._down_filtered = self._down.read()
+        self._start_up_ts = _NOT_PRESSED
+        self._start_down_ts = _NOT_PRESSED
+
+    @micropython.native
     def poll_button_event(self) -> int:
         """
         Check if there is any new button event. This function must be called periodically.
         """
 
-        # Read the button states and if pressed note down the ts when we first registered
-        # the event.
-        ts = time.ticks_ms()
-        if self._up.read() < TOUCH_ADC_THRESHOLD:
-            if self._start_up_ts is None:
-                self._start_up_ts = ts
-        else:
-            self._start_up_ts = None
-
-        if self._down.read() < TOUCH_ADC_THRESHOLD:
-            if self._start_down_ts is None:
-                self._start_down_ts = ts
-        else:
-            self._start_down_ts = None
-
-        # print(f"{self._start_up_ts=} {self._start_down_ts=}")
-
-        # Check if the currently registered presses exceeded the debounce thresholds, and,
-        # if yes, fire an event.
-        if self._start_up_ts is not None and self._start_down_ts is None:
-            if time.ticks_diff(ts, self._start_up_ts) > BUTTON_PRESS_EVENT_THRESHOLD_MS:
-                return ButtonEvent.UP
-        elif self._start_up_ts is None and self._start_down_ts is not None:
-            if (
-                time.ticks_diff(ts, self._start_down_ts)
-                > BUTTON_PRESS_EVENT_THRESHOLD_MS
-            ):
-                return ButtonEvent.DOWN
-        elif self._start_up_ts is not None and self._start_down_ts is not None:
-            if (
-                time.ticks_diff(ts, self._start_up_ts) > BUTTON_PRESS_EVENT_THRESHOLD_MS
-                and time.ticks_diff(ts, self._start_down_ts)
-                > BUTTON_PRESS_EVENT_THRESHOLD_MS
-            ):
-                return ButtonEvent.BOTH
-
-        return ButtonEvent.NONE
+        # Sample each touch pad only once per call, each read is a full ADC acquisition.
+        # The filtered values are cheap to compute (a shift) and suppress single noisy
+        # readings, so the debounce threshold can be short.
+        up_filtered = self._up_filtered
+        up_filtered += (self._up.read() - up_filtered) >> TOUCH_FILTER_SHIFT
+        self._up_filtered = up_filtered
+        down_filtered = self._down_filtered
+        down_filtered += (self._down.read() - down_filtered) >> TOUCH_FILTER_SHIFT
+        self._down_filtered = down_filtered
+
+        up = up_filtered < TOUCH_ADC_THRESHOLD
+        down = down_filtered < TOUCH_ADC_THRESHOLD
+        tdf = ticks_diff
+        ts = ticks_ms()
+
+        # If pressed note down the ts when we first registered the press.
+        if not up:
+            self._start_up_ts = _NOT_PRESSED
+        elif self._start_up_ts == _NOT_PRESSED:
+            self._start_up_ts = ts
+
+        if not down:
+            self._start_down_ts = _NOT_PRESSED
+        elif self._start_down_ts == _NOT_PRESSED:
+            self._start_down_ts = ts
+
+        # Only fire an event if all currently registered presses exceeded the debounce
+        # threshold. Otherwise, pressing both buttons would fire the event of the one
+        # that was touched first.
+        if up and tdf(ts, self._start_up_ts) <= BUTTON_PRESS_EVENT_THRESHOLD_MS:
+            return _EVT_NONE
+        if down and tdf(ts, self._start_down_ts) <= BUTTON_PRESS_EVENT_THRESHOLD_MS:
+            return _EVT_NONE
+        return _EVENT_LUT[(up << 1) | down]
 
 settings = Settings()
 
@@ -237,133 +399,171 @@ touch1 = TouchPad(Pin(15, Pin.IN))
 touch2 = TouchPad(Pin(4, Pin.IN))
 buttons = Buttons(touch1, touch2)
 
-def basic_mode_loop():
+async def basic_mode_loop():
     while True:
+        await asyncio.sleep_ms(BUTTON_POLL_INTERVAL_MS)
         button_event = buttons.poll_button_event()
 
-        if button_event == ButtonEvent.UP:
+        if button_event == _EVT_UP:
             print("up")
-            ts = time.ticks_ms()
-            print(f"start {ts=}")
+            if _TRACE:
+                ts = ticks_ms()
+                print(f"start {ts=}")
             blind.up()
-            ret = rotation_sensor.wait_for_sync_position(8000)
+            ret = await rotation_sensor.wait_for_sync_position(8000)
+            buttons.reset()
             # todo: move down if this fails, as well as in the case below
-            ts = time.ticks_ms()
-            print(f"stop {ts=} {ret=}")
+            if _TRACE:
+                ts = ticks_ms()
+                print(f"stop {ts=} {ret=}")
 
-        elif button_event == ButtonEvent.DOWN:
+        elif button_event == _EVT_DOWN:
             print("down")
-            ts = time.ticks_ms()
-            print(f"start {ts=}")
+            if _TRACE:
+                ts = ticks_ms()
+                print(f"start {ts=}")
             blind.down()
-            ret = rotation_sensor.wait_for_sync_position(3000)
-            ts = time.ticks_ms()
-            print(f"stop {ts=} {ret=}")
-        elif button_event == ButtonEvent.BOTH:
+            ret = await rotation_sensor.wait_for_sync_position(3000)
+            buttons.reset()
+            if _TRACE:
+                ts = ticks_ms()
+                print(f"stop {ts=} {ret=}")
+        elif button_event == _EVT_BOTH:
             blind.stop()
             break
         else:
             blind.stop()
 
-def move_up_until_blocked_and_count_steps():
+async def move_up_until_blocked_and_count_steps():
     # calibrate
     steps = 0
-    up_time_offset = 0
     endpos_on_magnet = False
 
+    rotation_sensor.reset_relativ_position()
     blind.up()
     while True:
-        ret = rotation_sensor.wait_for_sync_position(8000)
+        ret = await rotation_sensor.wait_for_sync_position(8000)
         if ret:
-            steps += 1
-            print(f"{steps=}")
+            if _TRACE:
+                print(f"steps={rotation_sensor.get_relative_position()}")
         else:
+            # The counter tells us how many magnets we passed until we got blocked.
+            steps = rotation_sensor.get_relative_position()
             endpos_on_magnet = rotation_sensor.is_in_sync_position()
             blind.down()
-            rotation_sensor.wait_for_sync_position(3000)
+            await rotation_sensor.wait_for_sync_position(3000)
             if endpos_on_magnet:
                 blind.up()
-                rotation_sensor.wait_for_sync_position(8000)
+                await rotation_sensor.wait_for_sync_position(8000)
             blind.stop()
             break
 
     print(f"{steps=}")
     return steps
 
-def advanced_mode_loop(current_position: int | None):
-    # Steps to fully close/open the blind.
-    number_of_total_steps = settings.number_of_total_steps()
-    assert number_of_total_steps is not None
+def halt_after_fault():
+    """
+    Stop the blind and enter deep sleep. Waking up from deep sleep resets the device,
+    thus we start over after FAULT_RETRY_DELAY_MS.
+    """
+    blind.stop()
+    settings.flush()
+    deepsleep(FAULT_RETRY_DELAY_MS)
 
-    if current_position is None:
-        # Make sure we are at a know position by moving the blind up until it is blocked.
-        #
-        # Alternatively, this could be solved by storing the last known position
-        # in the settings. However, this value would be written each time the blind
-        # is operated, but only read rarely. Not sure whether this is worth writing
-        # that much to the flash memory.
-        move_up_until_blocked_and_count_steps()
-        # We are now at the top postion since we moved there.
-        current_position = number_of_total_steps
+@micropython.native
+async def move_blind(position: int, step: int, timeout_ms: int, target_position: int):
+    """
+    Move the blind from `position` to `target_position` while counting magnets. The blind
+    moves up if `step` is positive and down otherwise, `step` is added to the position
+    per magnet.
+    Returns the new position or None if we did not see the next magnet within `timeout_ms`.
+    In both cases, the blind is stopped afterwards.
+    """
+    if step > 0:
+        blind.up()
+    else:
+        blind.down()
+    while position != target_position:
+        if not await rotation_sensor.wait_for_sync_position(timeout_ms):
+            blind.stop()
+            return None
+        position += step
+        if _TRACE:
+            print(f"{position=}")
+    blind.stop()
+    return position
+
+async def advanced_mode_loop(stop_position: int, start_position: int):
+    """
+    `stop_position` is the number of steps to fully close/open the blind, and
+    `start_position` must be either 0 or `stop_position`.
+    """
+    current_position = start_position
+
+    # The buttons have not been polled while calibrating or homing.
+    buttons.reset()
 
     while True:
+        await asyncio.sleep_ms(BUTTON_POLL_INTERVAL_MS)
         # TODO: Add support for events coming via MQTT.
         button_event = buttons.poll_button_event()
 
         # TODO: Incremental movements.
         # TODO: Reset device key combination.
         # TODO: Allow to cancel ongoing movements.
-        if button_event == ButtonEvent.UP:
-            if current_position == 0:
-                blind.up()
-                while True:
-                    ret = rotation_sensor.wait_for_sync_position(8000)
-                    if ret:
-                        current_position += 1
-                        print(f"{current_position=}")
-                    else:
-                        print("Failed up")
-                        blind.stop()
-                        while True:
-                            pass
-                    if current_position == number_of_total_steps:
-                        blind.stop()
-                        break
-        elif button_event == ButtonEvent.DOWN:
-            if current_position == number_of_total_steps:
-                blind.down()
-                while True:
-                    ret = rotation_sensor.wait_for_sync_position(3000)
-                    if ret:
-                        current_position -= 1
-                        print(f"{current_position=}")
-                    else:
-                        print("Failed down")
-                        blind.stop()
-                        while True:
-                            pass
-                    if current_position == 0:
-                        blind.stop()
-                        break
+        if button_event == _EVT_UP and current_position < stop_position:
+            step, timeout_ms, target_position = 1, 8000, stop_position
+            failure = "Failed up"
+        elif button_event == _EVT_DOWN and current_position > 0:
+            step, timeout_ms, target_position = -1, 3000, 0
+            failure = "Failed down"
         else:
             blind.stop()
+            continue
+
+        # We do not know where we are if we lose power while moving. Together with
+        # persisting the position once we arrived, these are two commits per movement.
+        settings.invalidate_current_position()
+        settings.flush()
+        ret = await move_blind(current_position, step, timeout_ms, target_position)
+        if ret is None:
+            print(failure)
+            halt_after_fault()
+        current_position = ret
+        buttons.reset()
+
+        settings.set_current_position(current_position)
+        settings.flush()
+
+async def main():
+    number_of_total_steps = settings.number_of_total_steps()
+    print(f"{number_of_total_steps=}")
+
+    # On start-up unknown, unless it was persisted after the last movement.
+    current_position = settings.current_position()
+
+    if number_of_total_steps is None:
+        await basic_mode_loop()
+        # if the basic mode is exited, the user request calibration.
+        # Thus, we now count the number of steps required until the blind
+        # is fully open/closed.
+        number_of_total_steps = await move_up_until_blocked_and_count_steps()
+        # We just estimated the value, thus we now our current position.
+        current_position = number_of_total_steps
+        settings.set_number_of_total_steps(number_of_total_steps)
+        settings.set_current_position(current_position)
+        settings.flush()
+    elif current_position not in (0, number_of_total_steps):
+        # Only the fully open or closed positions are persisted, anything else is stale.
+        # Make sure we are at a know position by moving the blind up until it is blocked.
+        await move_up_until_blocked_and_count_steps()
+        # We are now at the top postion since we moved there.
+        current_position = number_of_total_steps
+        settings.set_current_position(current_position)
+        settings.flush()
+
+    # If we know the number of steps required to close/open the blind we can
+    # enter the advanced mode.
+    await advanced_mode_loop(number_of_total_steps, current_position)
 
-number_of_total_steps = settings.number_of_total_steps()
-print(f"{number_of_total_steps=}")
-
-# On start-up unknown.
-current_position = None
-
-if number_of_total_steps is None:
-    basic_mode_loop()
-    # if the basic mode is exited, the user request calibration.
-    # Thus, we now count the number of steps required until the blind
-    # is fully open/closed.
-    number_of_total_steps = move_up_until_blocked_and_count_steps()
-    settings.set_number_of_total_steps(number_of_total_steps)
-    # We just estimated the value, thus we now our current position.
-    current_position = number_of_total_steps
-
-# If we know the number of steps required to close/open the blind we can
-# enter the advanced mode.
-advanced_mode_loop(current_position)
+asyncio.run(main())